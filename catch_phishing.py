@@ -11,18 +11,23 @@
 # GNU General Public License for more details.
 import re
 import math
+from collections import Counter
+from functools import lru_cache
 
+import ahocorasick
 import certstream
 import tqdm
 import yaml
 import time
 import os
+import queue
+import threading
 from Levenshtein import distance
-from termcolor import colored, cprint
-from tld import get_tld
+from tld.utils import get_tld_names
 
 from confusables import unconfuse
 import argparse
+import atexit
 
 from datetime import datetime, timezone
 import csv
@@ -39,44 +44,164 @@ EXTERNAL_YAML_DEFAULT = os.path.dirname(os.path.realpath(__file__))+'/external.y
 
 WHITELIST_YAML_DEFAULT = os.path.dirname(os.path.realpath(__file__))+'/whitelist.yaml'
 
+# ANSI escape sequences used to highlight the suspicious domains, unless
+# disabled through the ANSI_COLORS_DISABLED environment variable.
+if os.getenv('ANSI_COLORS_DISABLED') is None:
+    RED_BOLD_UNDERLINE = '\033[1;4;31m'
+    RED_UNDERLINE = '\033[4;31m'
+    YELLOW_UNDERLINE = '\033[4;33m'
+    UNDERLINE = '\033[4m'
+    RESET = '\033[0m'
+else:
+    RED_BOLD_UNDERLINE = RED_UNDERLINE = YELLOW_UNDERLINE = UNDERLINE = RESET = ''
+
+# os.cpu_count() returns None when the number of CPUs is undetermined
+WORKERS_DEFAULT = os.cpu_count() or 1
+
+MESSAGES_QUEUE_SIZE = 10000
+
+LOG_BUFFER_SIZE = 1 << 16
+
+LOG_FLUSH_ROWS = 100
+
+LOG_FLUSH_INTERVAL = 1.0
+
+# Words too generic to be compared to the strong keywords
+GENERIC_WORDS = frozenset(['email', 'mail', 'cloud'])
+
+# Unconfused domains may still hold non-ASCII letters, so keep the
+# Unicode-aware \W rather than an ASCII-only class.
+WORDS_SEPARATOR = re.compile(r"\W+")
+
 def entropy(string):
     """Calculates the Shannon entropy of a string"""
-    prob = [ float(string.count(c)) / len(string) for c in dict.fromkeys(list(string)) ]
-    entropy = - sum([ p * math.log(p) / math.log(2.0) for p in prob ])
+    # Count every character in a single pass instead of one
+    # str.count() scan per distinct character. With p = n / length,
+    # - sum(p * log2(p)) = log2(length) - sum(n * log2(n)) / length
+    # which avoids a division per character.
+    length = len(string)
+    if not length:
+        return 0.0
+    entropy = math.log2(length) - sum([ n * math.log2(n) for n in Counter(string).values() ]) / length
     return entropy
 
+def one_edit_apart(word, key):
+    """Check whether `word` is exactly one edit away from `key`.
+
+    Args:
+        word (str): the word found in the domain.
+        key (str): the keyword to compare it to.
+
+    Returns:
+        bool: True if the Levenshtein distance between both is 1.
+    """
+    # Words whose length differs by more than one character can't be
+    # a single edit away, no need to run the full distance computation.
+    if abs(len(word) - len(key)) > 1:
+        return False
+    return distance(word, key) == 1
+
+def split_domain(domain):
+    """Split `domain` into its subdomain and registered domain name.
+
+    This gives the same result as `get_tld(domain, as_object=True)`, but
+    only probes the public suffix list instead of parsing `domain` as an
+    URL and building a result object.
+
+    Args:
+        domain (str): the domain to split.
+
+    Returns:
+        tuple: the `(subdomain, domain)` pair, or None if `domain` has
+        no known public suffix.
+    """
+    parts = domain.split('.')
+    # Try the longest suffix first (ie. google.co.uk, then co.uk, then uk)
+    for i in range(len(parts)):
+        match = '.'.join(parts[i:])
+        if (match in public_suffixes or
+                '.'.join(['*'] + parts[i + 1:]) in public_suffixes or
+                '!' + match in public_suffixes):
+            # If the domain is only a suffix, its first label is the domain
+            i = max(1, i)
+            return '.'.join(parts[:i - 1]), parts[i - 1]
+    return None
+
+def build_keywords_automaton(keywords):
+    """Build an Aho-Corasick automaton over the suspicious keywords.
+
+    This allows finding every keyword contained in a domain in a single
+    pass, instead of testing each keyword separately. Keywords are
+    lowercased, as the domains are, so that the matching is caseless.
+
+    Args:
+        keywords (dict): the keywords and their scores.
+
+    Returns:
+        tuple: the `(automaton, scores)` pair. The automaton maps each
+        keyword to the index of its score in the `scores` tuple. When
+        there are no keywords, `scores` is empty and the automaton can't
+        be searched.
+    """
+    automaton = ahocorasick.Automaton()
+    scores = []
+    for word, score in keywords.items():
+        key = str(word).lower()
+        # The lowercase spelling of a keyword wins over the other ones
+        if key != word and key in keywords:
+            continue
+        if key in automaton:
+            scores[automaton.get(key)] = score
+        else:
+            automaton.add_word(key, len(scores))
+            scores.append(score)
+    automaton.make_automaton()
+    return automaton, tuple(scores)
+
+def normalize_domain(domain):
+    """Normalize `domain` before scoring it.
+
+    Args:
+        domain (str): the domain found in a certificate.
+
+    Returns:
+        str: the lowercase `domain`, without the initial '*.' of wildcard
+        certificates.
+    """
+    domain = domain.lower()
+    if domain.startswith('*.'):
+        domain = domain[2:]
+    return domain
+
+# The score only depends on the domain and on the configuration, which
+# is loaded once at startup: domains seen again in the stream are served
+# from the cache.
+@lru_cache(maxsize=131072)
 def score_domain(domain):
     """Score `domain`.
 
     The highest score, the most probable `domain` is a phishing site.
 
     Args:
-        domain (str): the domain to check.
+        domain (str): the domain to check, normalized by normalize_domain().
 
     Returns:
         int: the score of `domain`.
     """
     score = 0
 
-    for t in suspicious['whitelist']:
-        if domain.endswith(t):
-            # this should already be set to 0!
-            return score
+    # str.endswith() checks all the suffixes of a tuple at once
+    if domain.endswith(whitelist):
+        # this should already be set to 0!
+        return score
 
-    for t in suspicious['tlds']:
-        if domain.endswith(t):
-            score += 20
-
-    # Remove initial '*.' for wildcard certificates bug
-    if domain.startswith('*.'):
-        domain = domain[2:]
+    if domain.endswith(tlds):
+        score += 20
 
     # Removing TLD to catch inner TLD in subdomain (ie. paypal.com.domain.com)
-    try:
-        res = get_tld(domain, as_object=True, fail_silently=True, fix_protocol=True)
-        domain = '.'.join([res.subdomain, res.domain])
-    except Exception:
-        pass
+    res = split_domain(domain)
+    if res is not None:
+        domain = '.'.join(res)
 
     # Higer entropy is kind of suspicious
     score += int(round(entropy(domain)*10))
@@ -84,23 +209,27 @@ def score_domain(domain):
     # Remove lookalike characters using list from http://www.unicode.org/reports/tr39
     domain = unconfuse(domain)
 
-    words_in_domain = re.split(r"\W+", domain)
+    words_in_domain = WORDS_SEPARATOR.split(domain)
 
     # ie. detect fake .com (ie. *.com-account-management.info)
     if words_in_domain[0] in ['com', 'net', 'org']:
         score += 10
 
     # Testing keywords
-    for word in suspicious['keywords']:
-        if word in domain:
-            score += suspicious['keywords'][word]
+    # Each keyword only counts once, even if found several times
+    if keywords_scores:
+        for i in {i for _, i in keywords_automaton.iter(domain)}:
+            score += keywords_scores[i]
 
     # Testing Levenshtein distance for strong keywords (>= 70 points) (ie. paypol)
-    for key in [k for (k,s) in suspicious['keywords'].items() if s >= 70]:
+    # Skipped when no word is close enough in length to any of them.
+    if any(len(w) in strong_keywords_lengths for w in words_in_domain):
         # Removing too generic keywords (ie. mail.domain.com)
-        for word in [w for w in words_in_domain if w not in ['email', 'mail', 'cloud']]:
-            if distance(str(word), str(key)) == 1:
-                score += 70
+        words = [w for w in words_in_domain if w not in GENERIC_WORDS]
+        for key in strong_keywords:
+            for word in words:
+                if one_edit_apart(word, key):
+                    score += 70
 
     # Lots of '-' (ie. www.paypal-datacenter.com-acccount-alert.com)
     if 'xn--' not in domain and domain.count('-') >= 4:
@@ -113,65 +242,148 @@ def score_domain(domain):
     return score
 
 
-def callback(message, context):
-    """Callback handler for certstream events."""
-    if message['message_type'] == "heartbeat":
-        return
+def certificate_details(message):
+    """Format the certificate fields of the detailed suspicious domain log.
 
+    Args:
+        message (dict): the certstream `certificate_update` event.
+
+    Returns:
+        list: the fields following the domain and its score in the log.
+    """
+    return [
+        "|".join(message["data"]["leaf_cert"]["all_domains"]),
+        message["data"]["leaf_cert"]["fingerprint"],
+        message["data"]["leaf_cert"]["serial_number"],
+        datetime.fromtimestamp(message["data"]["leaf_cert"]["not_before"], tz=timezone.utc).strftime(TIMESTAMP_OUTPUT_FORMAT),
+        datetime.fromtimestamp(message["data"]["leaf_cert"]["not_after"], tz=timezone.utc).strftime(TIMESTAMP_OUTPUT_FORMAT),
+        message["data"]["leaf_cert"]["subject"]["aggregated"],
+        datetime.fromtimestamp(message["data"]["seen"], tz=timezone.utc).strftime(TIMESTAMP_OUTPUT_FORMAT),
+        message["data"]["source"]["name"],
+        message["data"]["source"]["url"],
+        message["data"]["update_type"]
+    ]
+
+def process_message(message):
+    """Score the domains of a certstream event and report suspicious ones."""
     if message['message_type'] == "certificate_update":
         all_domains = message['data']['leaf_cert']['all_domains']
+        details = None
 
-        for domain in all_domains:
-            pbar.update(1)
-            score = score_domain(domain.lower())
+        # The issuer is the same for all the domains of the certificate
+        # If issued from a free CA = more suspicious
+        if "Let's Encrypt" in message['data']['chain'][0]['subject']['aggregated']:
+            issuer_score = 10
+        else:
+            issuer_score = 0
 
-            # If issued from a free CA = more suspicious
-            if "Let's Encrypt" in message['data']['chain'][0]['subject']['aggregated']:
-                score += 10
+        # Certificates may list the same domain several times (ie. both
+        # example.com and *.example.com), only score and report it once
+        for domain in dict.fromkeys(normalize_domain(d) for d in all_domains):
+            score = score_domain(domain) + issuer_score
 
             if score >= 100:
                 tqdm.tqdm.write(
-                    "[!] Suspicious: "
-                    "{} (score={})".format(colored(domain, 'red', attrs=['underline', 'bold']), score))
+                    f"[!] Suspicious: {RED_BOLD_UNDERLINE}{domain}{RESET} (score={score})")
             elif score >= 90:
                 tqdm.tqdm.write(
-                    "[!] Suspicious: "
-                    "{} (score={})".format(colored(domain, 'red', attrs=['underline']), score))
+                    f"[!] Suspicious: {RED_UNDERLINE}{domain}{RESET} (score={score})")
             elif score >= 80:
                 tqdm.tqdm.write(
-                    "[!] Likely    : "
-                    "{} (score={})".format(colored(domain, 'yellow', attrs=['underline']), score))
+                    f"[!] Likely    : {YELLOW_UNDERLINE}{domain}{RESET} (score={score})")
             elif score >= 65:
                 tqdm.tqdm.write(
-                    "[+] Potential : "
-                    "{} (score={})".format(colored(domain, attrs=['underline']), score))
+                    f"[+] Potential : {UNDERLINE}{domain}{RESET} (score={score})")
 
             if score >= 75:
                 if not args.details:
-                    suspicious_writer.writerow(
+                    rows_queue.put(
                         [
                             domain
                         ]
                     )
                 else:
-                    suspicious_writer.writerow(
+                    # The certificate fields are the same for all its
+                    # domains, only format them once
+                    if details is None:
+                        details = certificate_details(message)
+                    rows_queue.put(
                         [
                             datetime.now(timezone.utc).strftime(TIMESTAMP_OUTPUT_FORMAT),
                             domain,
-                            score,
-                            "|".join(message["data"]["leaf_cert"]["all_domains"]),
-                            message["data"]["leaf_cert"]["fingerprint"],
-                            message["data"]["leaf_cert"]["serial_number"],
-                            datetime.fromtimestamp(message["data"]["leaf_cert"]["not_before"], tz=timezone.utc).strftime(TIMESTAMP_OUTPUT_FORMAT),
-                            datetime.fromtimestamp(message["data"]["leaf_cert"]["not_after"], tz=timezone.utc).strftime(TIMESTAMP_OUTPUT_FORMAT),
-                            message["data"]["leaf_cert"]["subject"]["aggregated"],
-                            datetime.fromtimestamp(message["data"]["seen"], tz=timezone.utc).strftime(TIMESTAMP_OUTPUT_FORMAT),
-                            message["data"]["source"]["name"],
-                            message["data"]["source"]["url"],
-                            message["data"]["update_type"]
-                        ]
+                            score
+                        ] + details
                     )
-                suspicious_file.flush()
+
+def score_worker():
+    """Process the certstream events queued by the callback, until a None
+    event."""
+    while True:
+        message = messages_queue.get()
+        if message is None:
+            break
+        try:
+            process_message(message)
+        except Exception as e:
+            # Keep the worker alive, a single malformed event must not
+            # stop the scoring of the following ones.
+            tqdm.tqdm.write(f"[-] Error processing event: {e!r}")
+
+def stop_workers(workers):
+    """Stop the `workers` threads once the queued events are processed."""
+    for _ in workers:
+        messages_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+def log_writer():
+    """Write the suspicious domain rows to the log, until a None row.
+
+    This is the only thread writing to the log file. Rows are flushed
+    every `LOG_FLUSH_ROWS` rows or `LOG_FLUSH_INTERVAL` seconds, rather
+    than after each row.
+    """
+    pending = 0
+    last_flush = time.monotonic()
+    while True:
+        try:
+            row = rows_queue.get(timeout=LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            pass
+        else:
+            if row is None:
+                break
+            suspicious_writer.writerow(row)
+            pending += 1
+
+        if pending and (pending >= LOG_FLUSH_ROWS or time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL):
+            suspicious_file.flush()
+            pending = 0
+            last_flush = time.monotonic()
+
+    suspicious_file.flush()
+
+def close_log(workers, writer):
+    """Stop the `workers` threads, then the `writer` thread once the
+    queued rows are written, and close the suspicious domain log."""
+    # The workers may still queue rows, stop them first
+    stop_workers(workers)
+    rows_queue.put(None)
+    writer.join()
+    suspicious_file.close()
+
+def callback(message, context):
+    """Callback handler for certstream events.
+
+    Events are only queued here, so that scoring them doesn't block the
+    certstream connection. Blocks when the workers are too far behind.
+    """
+    if message['message_type'] == "heartbeat":
+        return
+
+    if message['message_type'] == "certificate_update":
+        pbar.update(len(message['data']['leaf_cert']['all_domains']))
+        messages_queue.put(message)
 
 if __name__ == '__main__':
 
@@ -222,8 +434,18 @@ if __name__ == '__main__':
         help='Add more details to the suspicious domain log. DEFAULT: False.'
     )
 
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=WORKERS_DEFAULT,
+        help=f'Number of threads scoring the certstream events. DEFAULT: {WORKERS_DEFAULT}.'
+    )
+
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error(f"argument --workers/-w: must be at least 1, got {args.workers}")
+
     if args.debug:
         print("**********")
         print(f"Command line args: {args}")
@@ -246,11 +468,22 @@ if __name__ == '__main__':
 
         if external['tlds'] is not None:
             suspicious['tlds'].update(external['tlds'])
-    
+
+    public_suffixes = frozenset(get_tld_names())
+    whitelist = tuple(suspicious['whitelist'])
+    tlds = tuple(suspicious['tlds'])
+    keywords_automaton, keywords_scores = build_keywords_automaton(suspicious['keywords'])
+    # Use the automaton keywords, already lowercased and deduplicated
+    strong_keywords = tuple(k for (k, i) in keywords_automaton.items() if keywords_scores[i] >= 70)
+    # Lengths of the words which can be a single edit away from a strong keyword
+    strong_keywords_lengths = frozenset(
+        len(k) + d for k in strong_keywords for d in (-1, 0, 1)
+    )
+
     # Open the suspicious domain file for writing only once. The
     # callback will also access this globally.
     log_suspicious = args.suspicious_path
-    suspicious_file = open(log_suspicious, 'a')
+    suspicious_file = open(log_suspicious, 'a', buffering=LOG_BUFFER_SIZE)
     suspicious_writer = csv.writer(
         suspicious_file,
         dialect='excel'
@@ -274,4 +507,16 @@ if __name__ == '__main__':
         ]
     )
 
+    # Score events and write the log off the certstream thread. The
+    # callback and the workers will access these queues globally.
+    messages_queue = queue.Queue(maxsize=MESSAGES_QUEUE_SIZE)
+    rows_queue = queue.Queue()
+
+    workers = [threading.Thread(target=score_worker, daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    writer = threading.Thread(target=log_writer, daemon=True)
+    writer.start()
+    atexit.register(close_log, workers, writer)
+
     certstream.listen_for_events(callback, url=args.certstream_url)
@@ -1823,15 +1823,12 @@ confusables = {
     u'\u2CBA': '-'
 }
 
+# Every lookalike is a single character, so they can all be replaced
+# in a single str.translate() pass.
+confusables_table = str.maketrans(confusables)
+
 def unconfuse(domain):
     if domain.startswith('xn--') or domain.find('xn--'):
         domain = domain.encode('idna').decode('idna')
-    unconfused = ''
-    for i in range(len(domain)):
-        if domain[i] in confusables:
-            unconfused += confusables[domain[i]]
-        else:
-            unconfused += domain[i]
-
-    return unconfused
 
+    return domain.translate(confusables_table)